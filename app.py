@@ -1,6 +1,6 @@
 import streamlit as st
 from st_audiorec import st_audiorec
-import requests
+import httpx
 import io
 
 # --- UI Setup ---
@@ -9,6 +9,13 @@ st.set_page_config(page_title="Voice Assistant", layout="centered")
 # --- Configuration ---
 BACKEND_URL = "http://127.0.0.1:8000/api/chat"
 
+@st.cache_resource
+def _backend_client() -> httpx.Client:
+    """
+    One pooled HTTP client shared by every session, so each turn reuses an open connection to the backend.
+    """
+    return httpx.Client(http2=True, timeout=60, limits=httpx.Limits(max_keepalive_connections=4))
+
 # --- Custom CSS to hide unwanted buttons ---
 # This CSS is more specific and forceful to ensure the buttons are hidden.
 st.markdown("""
@@ -34,18 +41,14 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 if "last_audio" not in st.session_state:
     st.session_state.last_audio = None
-if "audio_to_play" not in st.session_state:
-    st.session_state.audio_to_play = None
+if "thread_id" not in st.session_state:
+    # Signed thread ID set by the backend on the first reply and sent back on later turns to keep the agent's context.
+    st.session_state.thread_id = None
 
 # --- Display Chat History ---
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
-        st.audio(message["audio"], format="audio/wav")
-
-# --- Autoplay Handler ---
-if st.session_state.audio_to_play:
-    st.audio(st.session_state.audio_to_play, format="audio/wav", autoplay=True)
-    st.session_state.audio_to_play = None
+        st.audio(message["audio"], format=message["format"])
 
 # --- Audio Recorder UI ---
 wav_audio_data = st_audiorec()
@@ -56,19 +59,22 @@ if wav_audio_data is not None and wav_audio_data != st.session_state.last_audio:
     
     with st.chat_message("user"):
         st.audio(wav_audio_data, format="audio/wav")
-    st.session_state.messages.append({"role": "user", "audio": wav_audio_data})
+    st.session_state.messages.append({"role": "user", "audio": wav_audio_data, "format": "audio/wav"})
 
     try:
         with st.spinner("Thinking..."):
             files = {'file': ('audio.wav', io.BytesIO(wav_audio_data), 'audio/wav')}
-            response = requests.post(BACKEND_URL, files=files, timeout=60)
+            # The client is shared across sessions, so send the thread_id explicitly instead of relying on its cookie jar.
+            headers = {'Cookie': f"thread_id={st.session_state.thread_id or ''}"}
+            response = _backend_client().post(BACKEND_URL, files=files, headers=headers)
 
         if response.status_code == 200:
+            st.session_state.thread_id = response.cookies.get("thread_id", st.session_state.thread_id)
             assistant_audio_bytes = response.content
+            # Autoplay the reply in its own bubble; on later reruns the history loop renders it without autoplay.
             with st.chat_message("assistant"):
-                st.audio(assistant_audio_bytes, format="audio/wav")
-            st.session_state.messages.append({"role": "assistant", "audio": assistant_audio_bytes})
-            st.session_state.audio_to_play = assistant_audio_bytes
+                st.audio(assistant_audio_bytes, format="audio/mpeg", autoplay=True)
+            st.session_state.messages.append({"role": "assistant", "audio": assistant_audio_bytes, "format": "audio/mpeg"})
             
         else:
             st.error(f"Error from server: {response.status_code} - {response.text}")
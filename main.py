@@ -1,15 +1,28 @@
 import os
+import asyncio
 import azure.cognitiveservices.speech as speechsdk
-# Import Response instead of StreamingResponse
-from fastapi import FastAPI, File, UploadFile, HTTPException, Request, Response
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-import io
+from fastapi.responses import JSONResponse, StreamingResponse
+import re
+import functools
+import itertools
+import hashlib
+import hmac
+import secrets
+from contextlib import asynccontextmanager
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import wave
+from typing import Optional
+import struct
+import numpy as np
 
-from azure.ai.projects import AIProjectClient
-from azure.identity import DefaultAzureCredential
-from azure.ai.agents.models import ListSortOrder
+from azure.core.exceptions import HttpResponseError
+from azure.ai.projects.aio import AIProjectClient
+from azure.identity.aio import AzureCliCredential, EnvironmentCredential, ManagedIdentityCredential, WorkloadIdentityCredential
+from azure.ai.agents.models import AgentStreamEvent, MessageDeltaChunk, ThreadRun
 
 # --- 1. Configuration ---
 load_dotenv()
@@ -27,7 +40,50 @@ if SPEECH_ENDPOINT:
 else:
     speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
 
-speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Riff24Khz16BitMonoPcm)
+# MP3 is a fraction of the size of PCM for speech, and because it is a sequence of self-contained
+# frames, the audio of several sentences can be streamed back-to-back as one file.
+TTS_MEDIA_TYPE = "audio/mpeg"
+speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Audio24Khz48KBitRateMonoMp3)
+
+# Number of synthesizers kept connected to the Speech service and shared across requests.
+TTS_POOL_SIZE = int(os.environ.get('TTS_POOL_SIZE', '4'))
+
+# Number of synthesized sentences kept in memory for repeated replies.
+TTS_CACHE_SIZE = int(os.environ.get('TTS_CACHE_SIZE', '512'))
+
+# Uploads shorter than this many seconds, or with a lower RMS level (16-bit PCM), are rejected without calling Azure.
+MIN_SPEECH_SECONDS = float(os.environ.get('MIN_SPEECH_SECONDS', '0.3'))
+MIN_SPEECH_RMS = float(os.environ.get('MIN_SPEECH_RMS', '200'))
+
+# Number of transcripts kept in memory for re-submitted audio (double submits, retries).
+STT_CACHE_SIZE = int(os.environ.get('STT_CACHE_SIZE', '256'))
+
+# Number of bytes read from a synthesis result's audio stream at a time.
+TTS_READ_SIZE = 4096
+
+# Number of bytes read from an upload and pushed to the recognizer at a time.
+AUDIO_CHUNK_SIZE = 32 * 1024
+
+# PCM layouts accepted for uploads. The recognizer only takes mono, so stereo uploads (which is what
+# the Streamlit recorder produces) are downmixed before they are pushed.
+MIN_FRAME_RATE = 8000
+MAX_FRAME_RATE = 48000
+SUPPORTED_BITS_PER_SAMPLE = (8, 16)
+SUPPORTED_CHANNELS = (1, 2)
+
+# Largest request body (the multipart audio upload) accepted by the API, in bytes.
+MAX_AUDIO_UPLOAD_BYTES = int(os.environ.get('MAX_AUDIO_UPLOAD_BYTES', str(10 * 1024 * 1024)))
+
+# Creating a SpeechSynthesizer opens a new websocket to Azure, so keep a pool of warm ones.
+# Each connection is opened up front so the first request skips the TLS handshake too.
+_synthesizers = []
+_synth_connections = []
+for _ in range(TTS_POOL_SIZE):
+    synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+    connection = speechsdk.Connection.from_speech_synthesizer(synthesizer)
+    connection.open(False)
+    _synth_connections.append(connection)
+    _synthesizers.append(synthesizer)
 
 # --- New Azure AI Agent Config ---
 AI_PROJECT_ENDPOINT = os.environ.get("AI_PROJECT_ENDPOINT")
@@ -36,10 +92,43 @@ AGENT_ID = os.environ.get("AGENT_ID")
 if not AI_PROJECT_ENDPOINT or not AGENT_ID:
     raise RuntimeError("AI_PROJECT_ENDPOINT and AGENT_ID environment variables are required.")
 
-# Initialize the AI Project Client. It will use your logged-in Azure credentials.
+def _select_credential():
+    """
+    Picks the single credential that applies to this environment, instead of letting
+    DefaultAzureCredential probe its whole chain (environment, managed identity, CLI, IDEs, ...).
+    AZURE_CREDENTIAL names the credential explicitly, for hosts whose managed identity is not
+    advertised through IDENTITY_ENDPOINT or MSI_ENDPOINT (e.g. Azure VMs and VM scale sets). Otherwise it is
+    a service principal from AZURE_CLIENT_* variables, workload identity when AKS has mounted a
+    federated token, the managed identity when running on an Azure host, and your Azure CLI login.
+    """
+    managed_identity = lambda: ManagedIdentityCredential(client_id=os.environ.get("AZURE_CLIENT_ID"))
+    credentials = {
+        "environment": EnvironmentCredential,
+        "workload": WorkloadIdentityCredential,
+        "managed_identity": managed_identity,
+        "cli": AzureCliCredential,
+    }
+
+    name = os.environ.get("AZURE_CREDENTIAL")
+    if name:
+        if name not in credentials:
+            raise RuntimeError(f"AZURE_CREDENTIAL must be one of: {', '.join(credentials)}.")
+        return credentials[name]()
+
+    if os.environ.get("AZURE_CLIENT_SECRET") or os.environ.get("AZURE_CLIENT_CERTIFICATE_PATH"):
+        return EnvironmentCredential()
+    if os.environ.get("AZURE_FEDERATED_TOKEN_FILE"):
+        return WorkloadIdentityCredential()
+    if os.environ.get("IDENTITY_ENDPOINT") or os.environ.get("MSI_ENDPOINT"):
+        return managed_identity()
+    return AzureCliCredential()
+
+# Initialize the async AI Project Client, so agent calls are awaited on the event loop instead of
+# blocking it. The client caches the token it gets from the credential and only refreshes it near expiry.
+credential = _select_credential()
 try:
     project_client = AIProjectClient(
-        credential=DefaultAzureCredential(),
+        credential=credential,
         endpoint=AI_PROJECT_ENDPOINT
     )
 except Exception as e:
@@ -47,12 +136,67 @@ except Exception as e:
     project_client = None
 
 
+# The thread_id cookie is signed, so a client can only continue a thread this backend gave it.
+# Every worker must share the same secret; without one, each process signs with its own random key.
+THREAD_COOKIE_SECRET = os.environ.get("THREAD_COOKIE_SECRET")
+if not THREAD_COOKIE_SECRET:
+    print("THREAD_COOKIE_SECRET is not set; using a random secret, so chats will not carry over between workers or restarts.")
+    THREAD_COOKIE_SECRET = secrets.token_hex(32)
+
+
 # --- 2. FastAPI Application Setup ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _tts_scheduler.start()
+    yield
+    await _tts_scheduler.stop()
+    # Close the async client's HTTP session and the credential's on shutdown.
+    if project_client:
+        await project_client.close()
+    await credential.close()
+
+class UploadSizeLimitMiddleware:
+    """
+    Rejects request bodies larger than max_bytes with 413 before FastAPI spools them. A declared
+    Content-Length is checked up front; otherwise (chunked uploads) the body is counted as it is received.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"Request bodies are limited to {self.max_bytes} bytes."
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI re-raises HTTPExceptions from body parsing, so this becomes a 413 response.
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 app = FastAPI(
     title="Speech-to-Text and Text-to-Speech API",
     description="An API that uses Azure services to transcribe user audio, get a mock response, and synthesize it back to audio.",
+    lifespan=lifespan,
 )
 
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=MAX_AUDIO_UPLOAD_BYTES)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -63,127 +207,652 @@ app.add_middleware(
 
 
 # --- 3. Core Service Functions ---
-async def speech_to_text_from_audio_data(audio_data: bytes) -> str:
-    """
-    Converts speech from in-memory audio data (in WAV format) to text using Azure Speech Service.
-    This version dynamically configures the audio stream format based on the WAV file's properties.
-    """
-    
-    # Use the 'wave' module to read the WAV file's properties and raw audio data.
-    with wave.open(io.BytesIO(audio_data), 'rb') as wave_file:
-        frame_rate = wave_file.getframerate()
-        sample_width = wave_file.getsampwidth()
-        n_channels = wave_file.getnchannels()
-        bits_per_sample = sample_width * 8
-        
-        # Read the raw audio frames (the actual sound data)
-        frames = wave_file.readframes(wave_file.getnframes())
-
-    # --- Create an AudioStreamFormat object to describe the raw audio ---
-    # This is the crucial step. We are telling the SDK exactly what kind of audio to expect.
-    stream_format = speechsdk.audio.AudioStreamFormat(
+class _LRUCache:
+    """
+    A small thread-safe least-recently-used cache. get() returns None on a miss.
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+# Synthesized audio keyed by sentence text, stored as the chunks it was streamed in.
+_tts_cache = _LRUCache(TTS_CACHE_SIZE)
+
+# Transcripts keyed by the SHA-256 of the uploaded audio and its declared PCM format, if any.
+_stt_cache = _LRUCache(STT_CACHE_SIZE)
+
+def _sign_thread_id(thread_id: str) -> str:
+    """
+    Returns the thread_id cookie value: the thread ID followed by its HMAC-SHA256 signature.
+    """
+    signature = hmac.new(THREAD_COOKIE_SECRET.encode(), thread_id.encode(), hashlib.sha256).hexdigest()
+    return f"{thread_id}.{signature}"
+
+def _verify_thread_cookie(value: Optional[str]) -> Optional[str]:
+    """
+    Returns the thread ID from a thread_id cookie, or None if the cookie is missing or was not signed by this backend.
+    """
+    if not value:
+        return None
+    thread_id, _, _ = value.rpartition(".")
+    if thread_id and hmac.compare_digest(_sign_thread_id(thread_id), value):
+        return thread_id
+    return None
+
+def _resolve_future(future: asyncio.Future, value) -> None:
+    """
+    Sets the result of a future unless it has already been resolved.
+    """
+    if not future.done():
+        future.set_result(value)
+
+# wFormatTag values for integer PCM, and for WAVE_FORMAT_EXTENSIBLE files whose SubFormat says what they hold.
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def _parse_wav(mv: memoryview) -> tuple:
+    """
+    Parses the RIFF header at the start of a WAV buffer without copying the audio data.
+    Returns (frame_rate, bits_per_sample, n_channels, frames, remaining), where frames is a view
+    of the raw audio that follows the header (truncated if the buffer ends early) and remaining
+    is how many bytes of the data chunk come after the buffer. Only PCM files are accepted.
+    """
+    if len(mv) < 12 or mv[0:4] != b'RIFF' or mv[8:12] != b'WAVE':
+        raise HTTPException(status_code=400, detail="The uploaded audio is not a valid WAV file.")
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(mv):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', mv, offset)
+        if chunk_id == b'fmt ':
+            if chunk_size < 16 or offset + 8 + chunk_size > len(mv):
+                raise HTTPException(status_code=400, detail="The uploaded audio has a truncated 'fmt ' chunk.")
+            # wFormatTag, nChannels, nSamplesPerSec, nAvgBytesPerSec, nBlockAlign, wBitsPerSample
+            fmt = struct.unpack_from('<HHIIHH', mv, offset + 8)
+            format_tag = fmt[0]
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                # The real format is the first two bytes of the SubFormat GUID.
+                (format_tag,) = struct.unpack_from('<H', mv, offset + 8 + 24)
+            if format_tag != WAVE_FORMAT_PCM:
+                raise HTTPException(status_code=400, detail="Only PCM WAV files are supported.")
+        elif chunk_id == b'data':
+            if fmt is None:
+                break
+            _, n_channels, frame_rate, _, _, bits_per_sample = fmt
+            data_offset = offset + 8
+            frames = mv[data_offset:data_offset + chunk_size]
+            return frame_rate, bits_per_sample, n_channels, frames, chunk_size - len(frames)
+        # Chunks are padded to an even number of bytes.
+        offset += 8 + chunk_size + (chunk_size & 1)
+
+    raise HTTPException(status_code=400, detail="The uploaded audio is missing its 'fmt ' or 'data' chunk.")
+
+def _parse_pcm_format(value: str) -> tuple:
+    """
+    Parses an X-PCM-Format header of the form '<frame_rate>/<bits_per_sample>/<n_channels>',
+    e.g. '16000/16/1'. Returns (frame_rate, bits_per_sample, n_channels).
+    """
+    match = re.fullmatch(r'(\d+)/(\d+)/(\d+)', value.strip())
+    if not match:
+        raise HTTPException(status_code=400, detail="X-PCM-Format must look like '<frame_rate>/<bits_per_sample>/<n_channels>', e.g. '16000/16/1'.")
+    return tuple(int(group) for group in match.groups())
+
+def _check_pcm_layout(frame_rate: int, bits_per_sample: int, n_channels: int) -> None:
+    """
+    Raises a 400 unless the recognizer can decode the PCM layout, whether it came from the
+    X-PCM-Format header or a WAV file's fmt chunk.
+    """
+    if not MIN_FRAME_RATE <= frame_rate <= MAX_FRAME_RATE:
+        raise HTTPException(status_code=400, detail=f"The audio's frame rate must be between {MIN_FRAME_RATE} and {MAX_FRAME_RATE} Hz.")
+    if bits_per_sample not in SUPPORTED_BITS_PER_SAMPLE:
+        raise HTTPException(status_code=400, detail=f"The audio must have {' or '.join(map(str, SUPPORTED_BITS_PER_SAMPLE))} bits per sample.")
+    if n_channels not in SUPPORTED_CHANNELS:
+        raise HTTPException(status_code=400, detail="The audio must be mono or stereo.")
+
+@functools.lru_cache(maxsize=32)
+def _stream_format(frame_rate: int, bits_per_sample: int, n_channels: int) -> speechsdk.audio.AudioStreamFormat:
+    """
+    Returns the AudioStreamFormat for a PCM layout. Only a handful of layouts occur in practice
+    (the recorder's frame rate depends on the browser and device), so each distinct one is only
+    built once rather than on every request.
+    """
+    return speechsdk.audio.AudioStreamFormat(
         samples_per_second=frame_rate,
         bits_per_sample=bits_per_sample,
         channels=n_channels
     )
 
+def _downmix_to_mono(chunks, bits_per_sample: int, n_channels: int):
+    """
+    Yields the audio in chunks as mono, averaging the channels of each frame. Bytes of a frame
+    split across two chunks are carried over to the next one. Mono audio is passed through as is.
+    """
+    if n_channels == 1:
+        yield from chunks
+        return
+
+    dtype = np.dtype('<i2') if bits_per_sample == 16 else np.dtype('u1')
+    frame_size = dtype.itemsize * n_channels
+    carry = b''
+    for chunk in chunks:
+        data = carry + bytes(chunk)
+        usable = len(data) - len(data) % frame_size
+        carry = data[usable:]
+        if usable:
+            frames = np.frombuffer(data, dtype=dtype, count=usable // dtype.itemsize).reshape(-1, n_channels)
+            yield (frames.astype(np.int32).sum(axis=1) // n_channels).astype(dtype).tobytes()
+
+def _hash_spool(spool) -> bytes:
+    """
+    Returns the SHA-256 digest of an upload's spooled file, leaving it positioned at the start.
+    """
+    spool.seek(0)
+    digest = hashlib.sha256(usedforsecurity=False)
+    while chunk := spool.read(AUDIO_CHUNK_SIZE):
+        digest.update(chunk)
+    spool.seek(0)
+    return digest.digest()
+
+def _read_audio(spool, remaining: Optional[int]):
+    """
+    Yields the rest of an upload's audio from the spool, AUDIO_CHUNK_SIZE bytes at a time.
+    Stops after remaining bytes, so chunks after a WAV file's data (LIST, id3, ...) are never
+    treated as audio. remaining is None for headerless PCM, which runs to the end of the upload.
+    """
+    while remaining is None or remaining > 0:
+        chunk = spool.read(AUDIO_CHUNK_SIZE if remaining is None else min(AUDIO_CHUNK_SIZE, remaining))
+        if not chunk:
+            return
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+def _reject_silence(spool, frames, remaining: Optional[int], frame_rate: int, bits_per_sample: int, n_channels: int) -> None:
+    """
+    Raises a 400 for uploads that are too short or too quiet to contain speech, before any Azure call.
+    frames is the audio already read from the first chunk; the rest (up to remaining bytes) is read
+    from the spool, which is left where it was. Only 16-bit PCM is checked; other layouts go
+    straight to the recognizer.
+    """
+    if bits_per_sample != 16:
+        return
+
+    resume_at = spool.tell()
+    n_samples = 0
+    sum_of_squares = 0.0
+    for chunk in itertools.chain((frames,), _read_audio(spool, remaining)):
+        samples = np.frombuffer(chunk, dtype='<i2', count=len(chunk) // 2).astype(np.float64)
+        n_samples += samples.size
+        sum_of_squares += float(samples @ samples)
+    spool.seek(resume_at)
+
+    # An empty upload is too short whatever its header says, and would otherwise divide by zero below.
+    if n_samples == 0 or n_samples < MIN_SPEECH_SECONDS * frame_rate * n_channels:
+        raise HTTPException(status_code=400, detail="The recording is too short to contain speech.")
+    if (sum_of_squares / n_samples) ** 0.5 < MIN_SPEECH_RMS:
+        raise HTTPException(status_code=400, detail="The recording is too quiet to contain speech.")
+
+def _read_audio_header(spool, pcm_format: Optional[str]) -> tuple:
+    """
+    Reads the first chunk of an upload and returns (frame_rate, bits_per_sample, n_channels, frames,
+    remaining) like _parse_wav. Raises a 400 for layouts the recognizer cannot take, and for audio that
+    is too short or too quiet. Blocks on the spool, so it is run in a worker thread.
+    """
+    first_chunk = spool.read(AUDIO_CHUNK_SIZE)
+    if pcm_format:
+        # The client has declared its format up front, so the upload is raw audio with no header.
+        frame_rate, bits_per_sample, n_channels = _parse_pcm_format(pcm_format)
+        frames, remaining = first_chunk, None
+    else:
+        # The first chunk carries the WAV header. Parse it in place to get the file's properties.
+        frame_rate, bits_per_sample, n_channels, frames, remaining = _parse_wav(memoryview(first_chunk))
+    _check_pcm_layout(frame_rate, bits_per_sample, n_channels)
+
+    # Accidental clicks and silent clips would only come back from Azure as NoMatch after a full round trip.
+    _reject_silence(spool, frames, remaining, frame_rate, bits_per_sample, n_channels)
+    return frame_rate, bits_per_sample, n_channels, frames, remaining
+
+def _push_audio(push_stream, spool, frames, remaining: Optional[int], bits_per_sample: int, n_channels: int) -> None:
+    """
+    Writes the raw audio frames (without the header) to the push stream, then closes it to signal
+    that all the audio has been sent. Blocks on the spool, so it is run in a worker thread.
+    """
+    for chunk in _downmix_to_mono(itertools.chain((frames,), _read_audio(spool, remaining)), bits_per_sample, n_channels):
+        push_stream.write(bytes(chunk))
+    push_stream.close()
+
+async def speech_to_text_from_audio_data(file: UploadFile, pcm_format: Optional[str] = None) -> str:
+    """
+    Converts speech from an uploaded audio file to text using Azure Speech Service.
+    The upload is a WAV file, or headerless PCM when the client declares its layout in pcm_format
+    (the X-PCM-Format header). Starlette has already spooled the whole upload (to disk past 1 MB),
+    so hashing it, scanning it for silence and pushing it to the recognizer all run in worker
+    threads, keeping the event loop free. The push overlaps with the recognizer connecting to Azure.
+    """
+
+    # Starlette has already spooled the whole upload, so read the spool directly rather than
+    # going through UploadFile's async wrappers.
+    spool = file.file
+
+    # Identical audio always transcribes the same way, so a re-submitted clip skips Azure entirely.
+    cache_key = (await asyncio.to_thread(_hash_spool, spool), pcm_format)
+    cached_text = _stt_cache.get(cache_key)
+    if cached_text is not None:
+        print(f"Recognized (cached): {cached_text}") # Added for debugging
+        return cached_text
+
+    frame_rate, bits_per_sample, n_channels, frames, remaining = await asyncio.to_thread(_read_audio_header, spool, pcm_format)
+
+    # --- Get the AudioStreamFormat object that describes the raw audio ---
+    # This is the crucial step. We are telling the SDK exactly what kind of audio to expect.
+    # The audio is always pushed as mono; stereo uploads are downmixed on the way.
+    stream_format = _stream_format(frame_rate, bits_per_sample, 1)
+
     # --- Use a PushAudioInputStream with the specified format ---
     push_stream = speechsdk.audio.PushAudioInputStream(stream_format)
     audio_config = speechsdk.audio.AudioConfig(stream=push_stream)
-    
+
     speech_recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
-    
-    # Write the raw audio frames (without the header) to the push stream.
-    push_stream.write(frames)
-    # Close the stream to signal that we have sent all the audio data.
-    push_stream.close()
-    
-    # Perform a single, non-blocking recognition.
-    result = speech_recognizer.recognize_once_async().get()
-    
+
+    # The SDK raises its events on its own threads, so hand everything back to the event loop.
+    loop = asyncio.get_running_loop()
+    recognized_phrases: asyncio.Queue = asyncio.Queue()
+    session_stopped = loop.create_future()
+
+    def on_recognized(evt):
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech:
+            print(f"Recognized: {evt.result.text}") # Added for debugging
+            loop.call_soon_threadsafe(recognized_phrases.put_nowait, evt.result.text)
+
+    def on_canceled(evt):
+        # Reaching the end of the pushed audio is also reported as a cancellation; only errors matter here.
+        if evt.cancellation_details.reason == speechsdk.CancellationReason.Error:
+            loop.call_soon_threadsafe(_resolve_future, session_stopped, evt.cancellation_details)
+
+    def on_session_stopped(evt):
+        loop.call_soon_threadsafe(_resolve_future, session_stopped, None)
+
+    speech_recognizer.recognized.connect(on_recognized)
+    speech_recognizer.canceled.connect(on_canceled)
+    speech_recognizer.session_stopped.connect(on_session_stopped)
+    recognition_started = speech_recognizer.start_continuous_recognition_async()
+
+    # The push stream buffers the audio, so it can be written while the recognizer is still connecting.
+    await asyncio.gather(
+        asyncio.to_thread(_push_audio, push_stream, spool, frames, remaining, bits_per_sample, n_channels),
+        asyncio.to_thread(recognition_started.get),
+    )
+    cancellation_details = await session_stopped
+    await asyncio.to_thread(speech_recognizer.stop_continuous_recognition)
+
     # Check the result
-    if result.reason == speechsdk.ResultReason.RecognizedSpeech:
-        print(f"Recognized: {result.text}") # Added for debugging
-        return result.text
-    elif result.reason == speechsdk.ResultReason.NoMatch:
-        print("No speech could be recognized.") # Added for debugging
-        raise HTTPException(status_code=400, detail="No speech could be recognized.")
-    elif result.reason == speechsdk.ResultReason.Canceled:
-        cancellation_details = result.cancellation_details
+    if cancellation_details is not None:
         error_details = cancellation_details.error_details
         print(f"Speech Recognition canceled: {cancellation_details.reason}. Error: {error_details}") # Added for debugging
         raise HTTPException(status_code=500, detail=f"Speech Recognition canceled: {cancellation_details.reason}. Error: {error_details}")
-    
-    return ""
 
-def text_to_speech_to_stream(text: str) -> io.BytesIO:
+    phrases = []
+    while not recognized_phrases.empty():
+        phrases.append(recognized_phrases.get_nowait())
+
+    if not phrases:
+        print("No speech could be recognized.") # Added for debugging
+        raise HTTPException(status_code=400, detail="No speech could be recognized.")
+
+    user_text = " ".join(phrases)
+    _stt_cache.put(cache_key, user_text)
+    return user_text
+
+def text_to_speech_to_stream(text: str, synthesis: speechsdk.ResultFuture, emit) -> None:
     """
-    Converts text to speech and returns it as an in-memory audio stream (BytesIO).
-    This version uses the recommended method for in-memory synthesis.
+    Reads the MP3 audio of a started synthesis and passes it to emit() chunk by chunk as Azure produces it.
+    Synthesis is started with start_speaking_text_async, so the first chunk is available long
+    before the whole sentence is synthesized.
     """
-    # By setting audio_config to None, the SpeechSynthesizer will return the
-    # synthesized audio in memory on the result object.
-    speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-    
-    result = speech_synthesizer.speak_text_async(text).get()
-    
-    # Check the result
-    if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-        # The synthesized audio is available in result.audio_data as a bytes object.
-        return io.BytesIO(result.audio_data)
-    elif result.reason == speechsdk.ResultReason.Canceled:
+    # The synthesizers were created with audio_config set to None, so the audio is read from the result in memory.
+    result = synthesis.get()
+    if result.reason == speechsdk.ResultReason.Canceled:
         cancellation_details = result.cancellation_details
         raise HTTPException(status_code=500, detail=f"Text-to-Speech canceled: {cancellation_details.reason}. Error: {cancellation_details.error_details}")
-        
-    return None
 
-def get_agent_response(user_text: str) -> str:
+    chunks = []
+    audio_stream = speechsdk.AudioDataStream(result)
+    # read_data fills this buffer in place and blocks until more audio is available, so each chunk is a copy.
+    buffer = bytes(TTS_READ_SIZE)
+    while filled := audio_stream.read_data(buffer):
+        chunk = buffer[:filled]
+        chunks.append(chunk)
+        emit(chunk)
+
+    if audio_stream.status == speechsdk.StreamStatus.Canceled:
+        cancellation_details = audio_stream.cancellation_details
+        raise HTTPException(status_code=500, detail=f"Text-to-Speech canceled: {cancellation_details.reason}. Error: {cancellation_details.error_details}")
+
+    # Cache the chunks as sent instead of joining them into a second copy of the audio.
+    _tts_cache.put(text, tuple(chunks))
+
+def _settle_future(source: asyncio.Future, target: asyncio.Future) -> None:
+    """
+    Copies the outcome of a finished future onto another one, unless it is already resolved.
+    """
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+class TTSScheduler:
+    """
+    Shares the warm synthesizers between sentence synthesis jobs from concurrent requests. Each
+    reply's sentences wait in their own queue, and whenever a synthesizer is free a single drain
+    task hands it the next sentence of the reply with the fewest sentences being synthesized,
+    taking turns on ties. A long reply therefore can't hold another reply's first sentence
+    behind its own backlog. Cached sentences are answered in
+    submit() without queueing. The audio is read on a dedicated executor with one thread per
+    synthesizer, so TTS never takes threads from the default executor, which STT uses.
+    """
+
+    def __init__(self, synthesizers: list):
+        self._synthesizers = synthesizers
+        # Queued jobs per reply, in the order the replies take their turns.
+        self._pending = None
+        self._has_pending = None
+        self._in_flight = {}
+        self._idle = None
+        self._executor = None
+        self._drain_task = None
+
+    def start(self) -> None:
+        """
+        Starts the drain task on the running event loop. Called from the app's lifespan, so each
+        event loop serving the app gets its own queues and drain task.
+        """
+        self._pending = OrderedDict()
+        self._has_pending = asyncio.Event()
+        self._in_flight = {}
+        self._idle = asyncio.Queue()
+        for synthesizer in self._synthesizers:
+            self._idle.put_nowait(synthesizer)
+        self._executor = ThreadPoolExecutor(max_workers=len(self._synthesizers), thread_name_prefix="tts")
+        self._drain_task = asyncio.get_running_loop().create_task(self._drain())
+
+    async def stop(self) -> None:
+        """
+        Cancels the drain task and shuts down the executor. Jobs still queued are dropped.
+        """
+        if self._drain_task is None:
+            return
+        self._drain_task.cancel()
+        try:
+            await self._drain_task
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._pending = None
+        self._has_pending = None
+        self._in_flight = {}
+        self._idle = None
+        self._executor = None
+        self._drain_task = None
+
+    def submit(self, sentence: str, reply) -> tuple:
+        """
+        Queues a sentence for synthesis behind the earlier sentences of the same reply, identified
+        by any hashable reply object. Returns a queue that receives its audio chunks (ending with
+        None) and a future that raises if synthesis failed.
+        """
+        if self._drain_task is None:
+            raise RuntimeError("TTSScheduler has not been started.")
+
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        done = loop.create_future()
+        cached_chunks = _tts_cache.get(sentence)
+        if cached_chunks is not None:
+            for chunk in cached_chunks:
+                chunks.put_nowait(chunk)
+            chunks.put_nowait(None)
+            done.set_result(None)
+            return chunks, done
+
+        self._pending.setdefault(reply, deque()).append((sentence, chunks, done))
+        self._has_pending.set()
+        return chunks, done
+
+    def _next_job(self) -> Optional[tuple]:
+        """
+        Takes the next sentence of the reply with the fewest sentences in flight and moves that
+        reply to the back of the line. Sentences of abandoned replies are dropped. Returns
+        (reply, sentence, chunks, done), or None if nothing is queued.
+        """
+        while self._pending:
+            reply = min(self._pending, key=lambda queued: self._in_flight.get(queued, 0))
+            jobs = self._pending[reply]
+            sentence, chunks, done = jobs.popleft()
+            if jobs:
+                self._pending.move_to_end(reply)
+            else:
+                del self._pending[reply]
+            if not done.cancelled():
+                return reply, sentence, chunks, done
+        return None
+
+    async def _drain(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for a free synthesizer first, so the job is picked at the moment it can start
+            # and gets its executor thread straight away.
+            synthesizer = await self._idle.get()
+            while (job := self._next_job()) is None:
+                self._has_pending.clear()
+                await self._has_pending.wait()
+
+            reply, sentence, chunks, done = job
+            try:
+                self._dispatch(loop, synthesizer, reply, sentence, chunks, done)
+            except Exception as e:
+                self._idle.put_nowait(synthesizer)
+                chunks.put_nowait(None)
+                if not done.done():
+                    done.set_exception(e)
+
+    def _dispatch(self, loop: asyncio.AbstractEventLoop, synthesizer, reply, sentence: str, chunks: asyncio.Queue, done: asyncio.Future) -> None:
+        synthesis = synthesizer.start_speaking_text_async(sentence)
+        self._in_flight[reply] = self._in_flight.get(reply, 0) + 1
+
+        def emit(chunk):
+            loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+
+        def read():
+            try:
+                text_to_speech_to_stream(sentence, synthesis, emit)
+            finally:
+                emit(None)
+
+        def finished(reading: asyncio.Future):
+            if self._in_flight.get(reply, 0) > 1:
+                self._in_flight[reply] -= 1
+            else:
+                self._in_flight.pop(reply, None)
+            if self._idle is not None:
+                self._idle.put_nowait(synthesizer)
+            _settle_future(reading, done)
+
+        # Reading the audio blocks until Azure produces it, so it happens on the TTS executor.
+        loop.run_in_executor(self._executor, read).add_done_callback(finished)
+
+_tts_scheduler = TTSScheduler(_synthesizers)
+
+# A sentence ends at '.', '!' or '?' followed by whitespace, so decimals like "3.5" are not split.
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+
+async def synthesize_speech_stream(syntheses: asyncio.Queue):
+    """
+    Yields the MP3 audio of a reply as it is synthesized. syntheses receives the (chunks, done)
+    pair from TTSScheduler.submit for each sentence in order, followed by None. Sentences are
+    submitted as soon as the agent finishes writing them, so they synthesize ahead of playback.
+    A synthesis error is raised while nothing has been sent yet, so the endpoint can still
+    answer with an error status. Once audio is streaming, a failed sentence is logged and skipped.
+    """
+    started = False
+    while (synthesis := await syntheses.get()) is not None:
+        chunks, done = synthesis
+        try:
+            while (chunk := await chunks.get()) is not None:
+                started = True
+                yield chunk
+        except BaseException:
+            # The reply was abandoned mid-sentence (e.g. the client disconnected), so nobody will await it.
+            _discard_synthesis(done)
+            raise
+        try:
+            await done
+        except Exception as e:
+            if not started:
+                raise
+            print(f"Skipping a sentence that failed to synthesize: {e}")
+
+def _discard_synthesis(done: asyncio.Future) -> None:
+    """
+    Gives up on a sentence nobody will hear: a job still queued is cancelled so it never takes a
+    synthesizer, and the error of one that already failed is retrieved so it is not logged as unhandled.
+    """
+    if not done.cancel() and not done.cancelled():
+        done.exception()
+
+def _abandon_reply(agent_task: asyncio.Task, syntheses: asyncio.Queue) -> None:
     """
-    Calls the Azure AI Agent, sends the user's text, and returns the agent's response.
+    Stops the agent run behind a reply that will not be (fully) sent and discards its queued
+    sentences, so no more audio is synthesized for it.
+    """
+    agent_task.cancel()
+    while not syntheses.empty():
+        if (synthesis := syntheses.get_nowait()) is not None:
+            _discard_synthesis(synthesis[1])
+
+async def _prepend_chunk(first_chunk: bytes, chunks, on_close):
+    """
+    Yields an already-awaited first chunk followed by the rest of an async generator. When the
+    response ends, including when the client disconnects midway, the generator is closed and
+    on_close() is called.
+    """
+    try:
+        yield first_chunk
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+        on_close()
+
+async def create_agent_thread() -> Optional[str]:
+    """
+    Creates a new agent thread for a chat and returns its ID, or None if it could not be created.
     """
     if not project_client:
-        return "Error: AI Project Client is not initialized. Check server logs."
+        return None
 
-    print(f"User said: '{user_text}'")
-    
     try:
-        # 1. Create a new thread for this interaction
-        thread = project_client.agents.threads.create()
+        thread = await project_client.agents.threads.create()
         print(f"Created thread, ID: {thread.id}")
+        return thread.id
+    except Exception as e:
+        print(f"An error occurred while creating an AI Agent thread: {e}")
+        return None
 
-        # 2. Add the user's message to the thread
-        project_client.agents.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=user_text
-        )
+async def post_user_message(user_text: str, thread_id: Optional[str]) -> Optional[str]:
+    """
+    Adds the user's message to the chat's thread and returns the thread's ID, or None if the
+    message could not be posted. All turns of a chat go to the same thread, so the agent keeps
+    the conversation's context. A new thread is created on the first turn, and whenever the
+    client's thread no longer accepts messages (deleted, from another project, or stuck on an active run).
+    """
+    if not project_client:
+        return None
 
-        # 3. Run the agent and wait for it to process the message
-        run = project_client.agents.runs.create_and_process(
-            thread_id=thread.id,
-            agent_id=AGENT_ID
-        )
+    print(f"User said: '{user_text}'")
+
+    if thread_id:
+        try:
+            await project_client.agents.messages.create(thread_id=thread_id, role="user", content=user_text)
+            return thread_id
+        except HttpResponseError as e:
+            print(f"The chat's thread rejected the message, starting a new thread. Error: {e}")
 
-        if run.status == "failed":
-            print(f"Run failed: {run.last_error}")
-            return f"The agent encountered an error: {run.last_error}"
-        
-        # 4. Get all messages from the thread in DESCENDING order (newest first)
-        messages = project_client.agents.messages.list(thread_id=thread.id, order=ListSortOrder.DESCENDING)
-        
-        # Find the first message from the assistant, which will be the latest one.
-        assistant_response = "Sorry, I couldn't get a response."
-        for message in messages:
-            if message.role == "assistant" and message.text_messages:
-                assistant_response = message.text_messages[-1].text.value
-                break # Found the latest response, no need to continue
-        
-        print(f"Agent responded: '{assistant_response}'")
-        return assistant_response
+    thread_id = await create_agent_thread()
+    if thread_id is None:
+        return None
+
+    try:
+        await project_client.agents.messages.create(thread_id=thread_id, role="user", content=user_text)
+        return thread_id
+    except Exception as e:
+        print(f"An error occurred while posting the message to the AI Agent: {e}")
+        return None
+
+async def stream_agent_response(thread_id: Optional[str], speak) -> None:
+    """
+    Runs the Azure AI Agent on the chat's thread and streams its response. Each sentence is passed
+    to speak() as soon as the agent has finished writing it, rather than after the whole response.
+    Error messages are passed to speak() too, so the user hears them.
+    """
+    if not project_client:
+        speak("Error: AI Project Client is not initialized. Check server logs.")
+        return
+    if not thread_id:
+        speak("I'm sorry, but I couldn't start a conversation with the agent.")
+        return
+
+    assistant_response = ""
+    pending_text = ""
+    try:
+        # Run the agent, handing over each sentence of its response as it is streamed
+        run_error = None
+        async with await project_client.agents.runs.stream(thread_id=thread_id, agent_id=AGENT_ID) as stream:
+            async for event_type, event_data, _ in stream:
+                if isinstance(event_data, MessageDeltaChunk):
+                    assistant_response += event_data.text
+                    *sentences, pending_text = _SENTENCE_BOUNDARY.split(pending_text + event_data.text)
+                    for sentence in sentences:
+                        # Deltas often start with a space, which would otherwise split the TTS cache's keys.
+                        if sentence := sentence.strip():
+                            speak(sentence)
+                elif isinstance(event_data, ThreadRun) and event_data.status == "failed":
+                    run_error = event_data.last_error
+                elif event_type == AgentStreamEvent.ERROR:
+                    run_error = event_data
+
+        if pending_text.strip():
+            speak(pending_text.strip())
+
+        if run_error:
+            print(f"Run failed: {run_error}")
+            speak(f"The agent encountered an error: {run_error}")
+        elif not assistant_response.strip():
+            speak("Sorry, I couldn't get a response.")
+        else:
+            print(f"Agent responded: '{assistant_response}'")
 
     except Exception as e:
         print(f"An error occurred while interacting with the AI Agent: {e}")
-        return "I'm sorry, but I encountered an error while trying to process your request."
+        speak("I'm sorry, but I encountered an error while trying to process your request.")
 
 # --- 4. API Endpoint ---
 
@@ -192,24 +861,44 @@ async def chat_endpoint(request: Request, file: UploadFile = File(...)):
     """
     The main endpoint to handle the chat workflow.
     """
+    # The client carries its agent thread ID in a signed cookie, so any worker process can continue the chat
+    # and a client cannot pick someone else's thread.
+    thread_id = _verify_thread_cookie(request.cookies.get("thread_id"))
+
+    agent_task = None
     try:
-        audio_data = await file.read()
-        user_text = await speech_to_text_from_audio_data(audio_data)
+        user_text = await speech_to_text_from_audio_data(file, request.headers.get("X-PCM-Format"))
         if not user_text:
             raise HTTPException(status_code=400, detail="Could not understand the audio.")
 
-        agent_response_text = get_agent_response(user_text)
-        audio_response_stream = text_to_speech_to_stream(agent_response_text)
-        
-        
-        # Get the complete audio data as bytes
-        audio_bytes = audio_response_stream.getvalue()
-        # Return a regular Response with the full content and length, not a stream.
-        return Response(content=audio_bytes, media_type="audio/wav")
+        # Post to the chat's thread, or to a new one if this is the first turn or the old thread is unusable
+        thread_id = await post_user_message(user_text, thread_id)
+
+        # Run the agent in the background and start synthesizing each sentence as soon as it is written.
+        syntheses: asyncio.Queue = asyncio.Queue()
+        agent_task = asyncio.create_task(
+            stream_agent_response(thread_id, lambda sentence: syntheses.put_nowait(_tts_scheduler.submit(sentence, syntheses)))
+        )
+        agent_task.add_done_callback(lambda _: syntheses.put_nowait(None))
+
+        audio_chunks = synthesize_speech_stream(syntheses)
+        # Wait for the first chunk so synthesis errors are still reported with a proper status code.
+        first_chunk = await audio_chunks.__anext__()
+        response = StreamingResponse(
+            _prepend_chunk(first_chunk, audio_chunks, lambda: _abandon_reply(agent_task, syntheses)),
+            media_type=TTS_MEDIA_TYPE,
+        )
+        if thread_id:
+            response.set_cookie("thread_id", _sign_thread_id(thread_id), httponly=True, samesite="lax")
+        return response
 
     except HTTPException as e:
+        if agent_task is not None:
+            _abandon_reply(agent_task, syntheses)
         raise e
     except Exception as e:
+        if agent_task is not None:
+            _abandon_reply(agent_task, syntheses)
         print(f"An unexpected error occurred: {e}")
         raise HTTPException(status_code=500, detail=f"An internal server error occurred. Details: {str(e)}")
 